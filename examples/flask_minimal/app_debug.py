@@ -38,17 +38,6 @@ if __name__ == "__main__":
     logging.getLogger('aiohttp.client').setLevel(logging.WARNING)
     logging.getLogger('treblle').debug("Using treblle_flask from: %s", _treblle_pkg.__file__)
     
-    # Make Treblle non-blocking for debugging
-    from treblle_flask.telemetry_publisher import TelemetryPublisher
-    import asyncio
-    
-    def _send_no_wait(self, payload):
-        # schedule the coroutine on the publisher loop and return immediately
-        self._event_loop.call_soon_threadsafe(
-            asyncio.create_task, self._process_request(payload))
-    
-    TelemetryPublisher.send_to_treblle = _send_no_wait
-    
     # Run: python examples/flask_minimal/app.py
     # Ensure env vars are set:
     #   export TREBLLE_API_KEY=your-project-id
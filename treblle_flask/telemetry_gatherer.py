@@ -13,21 +13,51 @@ You shouldn't use this class directly, instead use Treblle class from the extens
 
 import base64
 import re
-from copy import deepcopy
 from datetime import datetime, timezone
-from flask import request, g
-from json import JSONDecodeError, dumps, loads
+from flask import current_app, request, g
+from json import JSONDecodeError, dumps
 from logging import getLogger
-from os import environ
+from os import environ, urandom
 from platform import python_version, system, release, machine
-from socket import getaddrinfo, gethostname, AF_INET
-from time import time
-from traceback import extract_tb
+from socket import getaddrinfo, gethostname, inet_pton, AF_INET
+from time import gmtime, time
 from types import GeneratorType
-from uuid import uuid4
+from treblle_flask.telemetry_publisher import RawJSON
 
 logger = getLogger('treblle')
 
+_BASE64_IMG_RE = re.compile(r'^data:image/[a-zA-Z]*;base64,[A-Za-z0-9+/]+={0,2}$')
+
+
+def _is_ipv4(ip):
+    # inet_pton only accepts the full dotted-quad form and also rejects out of range octets
+    try:
+        inet_pton(AF_INET, ip)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def _request_id():
+    # same format as str(uuid4()), including the version and variant bits, without building the UUID object
+    h = urandom(16).hex()
+    return f'{h[:8]}-{h[8:12]}-4{h[13:16]}-{"89ab"[int(h[16], 16) & 3]}{h[17:20]}-{h[20:]}'
+
+
+def _last_frame(tb):
+    # only the last frame is reported, walk to it instead of extracting the entire traceback
+    if tb is None:
+        return '', 0
+    while tb.tb_next is not None:
+        tb = tb.tb_next
+    return tb.tb_frame.f_code.co_filename, tb.tb_lineno
+
+
+def _utc_timestamp():
+    # same as datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S') without building datetime objects
+    t = gmtime()
+    return f'{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d} {t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}'
+
 
 class TelemetryGatherer:
     # Common authentication schemes, if authorization header starts with one of these strings, we'll mask the value,
@@ -40,6 +70,13 @@ class TelemetryGatherer:
     # Maximum response body size (2MB)
     MAX_RESPONSE_BODY_SIZE = 2 * 1024 * 1024
 
+    # Masked values are replaced with asterisks matching their length, capped so long secrets don't bloat the payload
+    MAX_MASK_LENGTH = 64
+    MASK = '*' * MAX_MASK_LENGTH
+
+    # Common image file headers, used to detect raw base64 encoded images
+    IMAGE_MAGIC = (b'\xff\xd8\xff', b'\x89PNG', b'GIF8', b'RIFF')
+
     def __init__(
         self, treblle_sdk_token, treblle_api_key, hidden_keys, mask_auth_header, limit_request_body_size,
         request_transformer, response_transformer, ignored_environments, debug
@@ -52,12 +89,14 @@ class TelemetryGatherer:
         """
 
         self._hidden_keys = set(key.lower() for key in hidden_keys) if hidden_keys else set()
+        self._quoted_hidden_keys = tuple(f'"{key}"'.encode('utf-8') for key in self._hidden_keys)
         self._should_mask_auth_header = mask_auth_header
         self._limit_request_body_size = limit_request_body_size
         self._request_transformer = request_transformer
         self._response_transformer = response_transformer
         self._ignored_environments = set(env.strip().lower() for env in ignored_environments) if ignored_environments else {'dev', 'test', 'testing'}
         self._debug = debug
+        self._endpoint_to_rule = None
         
         # Check if current environment should be ignored
         current_env = environ.get('FLASK_ENV', environ.get('ENV', 'production')).lower()
@@ -75,18 +114,25 @@ class TelemetryGatherer:
         except:
             server_timezone = 'UTC'
 
-        self._payload_template = {
-            'project_id': treblle_api_key, 'api_key': treblle_sdk_token,
+        # Static payload fields, these are never mutated after init, so they're shared between request payloads
+        self._project_id = treblle_api_key
+        self._api_key = treblle_sdk_token
+        self._server_block = {
+            'ip': host_ip,
+            'timezone': server_timezone,
+            'os': {'name': system() or 'Unknown', 'release': release() or 'Unknown', 'architecture': machine() or 'Unknown'},
+            'software': 'Flask',
+            'protocol': 'HTTP/1.1',
+        }
+        self._language_block = {'name': 'python', 'version': python_version() or 'Unknown'}
+
+    def _new_payload(self):
+        return {
+            'project_id': self._project_id, 'api_key': self._api_key,
             'sdk': 'flask', 'version': 1,
             'data': {
-                'server': {
-                    'ip': host_ip,
-                    'timezone': server_timezone,
-                    'os': {'name': system() or 'Unknown', 'release': release() or 'Unknown', 'architecture': machine() or 'Unknown'},
-                    'software': 'Flask',
-                    'protocol': 'HTTP/1.1',
-                },
-                'language': {'name': 'python', 'version': python_version() or 'Unknown'},
+                'server': self._server_block,
+                'language': self._language_block,
                 'errors': []
             }
         }
@@ -97,147 +143,191 @@ class TelemetryGatherer:
             return False
         
         # Check for common base64 image patterns
-        base64_image_pattern = r'^data:image/[a-zA-Z]*;base64,[A-Za-z0-9+/]+={0,2}$'
-        if re.match(base64_image_pattern, value):
+        if _BASE64_IMG_RE.match(value):
             return True
         
         # Check for raw base64 that might be an image (heuristic)
         try:
             decoded = base64.b64decode(value[:100])  # Check first 100 chars
-            # Common image file headers
-            if decoded.startswith((b'\xff\xd8\xff', b'\x89PNG', b'GIF8', b'RIFF')):
+            if decoded.startswith(self.IMAGE_MAGIC):
                 return True
         except:
             pass
         
         return False
 
+    def _mask_value(self, value):
+        value = str(value)
+        if self._is_base64_image(value):
+            return 'base64 encoded images are too big to process'
+        return self.MASK[:len(value)]
+
     def _mask_data(self, data):
-        if isinstance(data, dict):
-            masked_data = {}
-            for key, value in data.items():
-                key_lower = key.lower()
-                if key_lower in self._hidden_keys:
-                    if self._is_base64_image(str(value)):
-                        masked_data[key] = 'base64 encoded images are too big to process'
+        hidden_keys = self._hidden_keys
+        if not hidden_keys or not isinstance(data, (dict, list)):
+            return data
+
+        # walk the structure with an explicit stack instead of recursing, each entry holds the container to write
+        # the masked value into, the key/index to write it at and the original value
+        result = [None]
+        stack = [(result, 0, data)]
+        while stack:
+            parent, slot, value = stack.pop()
+            if isinstance(value, dict):
+                masked_data = {}
+                for key, item in value.items():
+                    if key.lower() in hidden_keys:
+                        masked_data[key] = self._mask_value(item)
                     else:
-                        masked_data[key] = '*' * len(str(value))
-                else:
-                    masked_data[key] = self._mask_data(value)
-            return masked_data
+                        masked_data[key] = item
+                        if isinstance(item, (dict, list)):
+                            stack.append((masked_data, key, item))
+                parent[slot] = masked_data
 
-        elif isinstance(data, list):
-            return [self._mask_data(item) for item in data]
+            else:
+                masked_data = list(value)
+                for index, item in enumerate(value):
+                    if isinstance(item, (dict, list)):
+                        stack.append((masked_data, index, item))
+                parent[slot] = masked_data
 
-        return data
+        return result[0]
 
     def _mask_auth_header(self, auth_header):
         if ' ' not in auth_header:
-            return '*'*len(auth_header)  # likely malformed, just mask the entire header
+            return self.MASK[:len(auth_header)]  # likely malformed, just mask the entire header
 
         auth_scheme, auth_value = auth_header.split(' ', maxsplit=1)
         if auth_scheme in self.COMMON_AUTH_SCHEMES:
-            return f'{auth_scheme} {"*"*len(auth_value)}'
+            return f'{auth_scheme} {self.MASK[:len(auth_value)]}'
+
+        return self.MASK[:len(auth_header)]
 
-        return '*'*len(auth_header)
+    def _can_skip_masking(self, body):
+        """Check if none of the hidden keys can be present in the raw JSON body, so it doesn't need to be masked"""
+        if not self._hidden_keys:
+            return True
+
+        # in an ASCII body without any escape sequences, object keys can only appear as literal quoted strings
+        if not body.isascii() or b'\\' in body:
+            return False
+        body = body.lower()
+        return not any(quoted_key in body for quoted_key in self._quoted_hidden_keys)
+
+    def _mask_headers(self, headers, mask_auth_header=False):
+        # single pass over the headers, applying both the sensitive header and the hidden keys masking
+        hidden_keys = self._hidden_keys
+        sensitive_headers = self.SENSITIVE_HEADERS
+        masked_headers = {}
+        for header_name, header_value in headers.items():
+            header_name_lower = header_name.lower()
+            if header_name_lower in sensitive_headers:
+                if header_name_lower == 'authorization' and mask_auth_header:
+                    header_value = self._mask_auth_header(header_value)
+                else:
+                    header_value = self.MASK[:len(header_value)]
+            if header_name_lower in hidden_keys:
+                header_value = self._mask_value(header_value)
+            masked_headers[header_name] = header_value
+        return masked_headers
+
+    @staticmethod
+    def _build_endpoint_to_rule(url_map):
+        endpoint_to_rule = {}
+        for rule in url_map.iter_rules():
+            # keep the first matching rule, same as a linear scan would
+            endpoint_to_rule.setdefault(rule.endpoint, rule.rule)
+        return endpoint_to_rule
 
     def handle_request(self):
         if self._disabled:
             return
 
-        payload = deepcopy(self._payload_template)
+        payload = self._new_payload()
+        mask_data = self._mask_data
 
-        # Keep the Flask software identifier we set in template
-        pass
+        # resolve the request proxy and the headers once, every attribute access on the proxy looks up the context
+        current_request = request._get_current_object()
+        headers = current_request.headers
+        request_headers = self._mask_headers(headers, self._should_mask_auth_header)
 
-        request_headers = dict(request.headers)
-        
-        # Mask sensitive headers
-        for header_name in list(request_headers.keys()):
-            if header_name.lower() in self.SENSITIVE_HEADERS:
-                if header_name.lower() == 'authorization' and self._should_mask_auth_header:
-                    request_headers[header_name] = self._mask_auth_header(request_headers[header_name])
-                else:
-                    request_headers[header_name] = '*' * len(request_headers[header_name])
-        
-        # Apply general masking
-        request_headers = self._mask_data(request_headers)
-
-        x_forwarded_for = request.headers.get('X-Forwarded-For', '').split(',')[0].strip()
-        request_ip = x_forwarded_for or request.remote_addr or 'bogon'
+        x_forwarded_for = headers.get('X-Forwarded-For', '').split(',')[0].strip()
+        request_ip = x_forwarded_for or current_request.remote_addr or 'bogon'
         
         # Extract first valid IPv4 address if multiple IPs are present
         if request_ip and ',' in request_ip:
             ips = [ip.strip() for ip in request_ip.split(',')]
             for ip in ips:
-                # Simple IPv4 validation
-                if re.match(r'^(\d{1,3}\.){3}\d{1,3}$', ip):
+                if _is_ipv4(ip):
                     request_ip = ip
                     break
             else:
                 request_ip = 'bogon'
-        elif not request_ip or not re.match(r'^(\d{1,3}\.){3}\d{1,3}$', request_ip or ''):
+        elif not request_ip or not _is_ipv4(request_ip):
             request_ip = 'bogon'
 
         # Get route path - try to get the actual route pattern
         route_path = None
         try:
-            if hasattr(request, 'endpoint') and request.endpoint:
-                from flask import current_app
-                for rule in current_app.url_map.iter_rules():
-                    if rule.endpoint == request.endpoint:
-                        route_path = rule.rule
-                        break
+            endpoint = getattr(current_request, 'endpoint', None)
+            if endpoint:
+                # routes can be registered after the first request, rebuild the cache when we meet a new endpoint
+                endpoint_to_rule = self._endpoint_to_rule
+                if endpoint_to_rule is None or endpoint not in endpoint_to_rule:
+                    endpoint_to_rule = self._endpoint_to_rule = self._build_endpoint_to_rule(current_app.url_map)
+                route_path = endpoint_to_rule.get(endpoint)
         except:
             pass
         
         # If we couldn't determine the parameterized route, omit it instead of null
-        if not route_path or route_path == request.path:
-            route_path = request.path  # Use actual path instead of null
-
-        payload['data']['request'] = {
-            'timestamp': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
-            'method': request.method or 'GET',
-            'url': request.url,
+        path = current_request.path
+        if not route_path or route_path == path:
+            route_path = path  # Use actual path instead of null
+
+        request_payload = payload['data']['request'] = {
+            'timestamp': _utc_timestamp(),
+            'method': current_request.method or 'GET',
+            'url': current_request.url,
             'route_path': route_path,
-            'user_agent': request.headers.get('User-Agent', ''),
+            'user_agent': headers.get('User-Agent', ''),
             'headers': request_headers,
             'ip': request_ip,
-            'query': self._mask_data(dict(request.args)),
+            'query': mask_data(dict(current_request.args)),
             'body': {},
         }
 
         # if the client is acting maliciously, they can still exhaust the server memory by not providing a
         # content-length header or setting transfer-encoding header to chunked, this is a best-effort mitigation,
         # there should be other mechanisms in place to prevent this in production environments
-        if (request.content_length or 0) < self._limit_request_body_size:
-            if self._request_transformer:
+        if (current_request.content_length or 0) < self._limit_request_body_size:
+            request_transformer = self._request_transformer
+            if request_transformer:
                 try:
-                    request_body = self._request_transformer(request.get_data())
+                    request_body = request_transformer(current_request.get_data())
                     try:
                         dumps(request_body)
                     except JSONDecodeError:
                         raise ValueError('Request transformer must return a JSON serializable object')
+                    request_body = mask_data(request_body)
 
                 except Exception as e:
-                    logger.error(f'Error in request transformer: {e.__class__.__name__}{e.args}')
-                    last_frame = extract_tb(e.__traceback__)[-1]
+                    logger.error('Error in request transformer: %s%s', e.__class__.__name__, e.args)
+                    file, line = _last_frame(e.__traceback__)
                     payload['data']['errors'].append({
                         'source': 'onError',
                         'type': e.__class__.__name__,
                         'message': ', '.join(str(f) for f in e.args),
-                        'file': last_frame.filename,
-                        'line': last_frame.lineno
+                        'file': file,
+                        'line': line
                     })
                     request_body = {}
 
             else:
-                try:
-                    request_body = loads(request.get_data().decode('utf-8', 'replace'))
-                except JSONDecodeError:
-                    request_body = {}
+                # parsing and masking is left to the publisher thread, if there's nothing to mask the raw body is
+                # spliced into the payload as-is
+                request_body = RawJSON(current_request.get_data(), mask_data, self._can_skip_masking)
 
-            payload['data']['request']['body'] = self._mask_data(request_body) if request_body else {}
+            request_payload['body'] = request_body if request_body else {}
 
         g.treblle_payload = payload
         g.treblle_start_time = time()
@@ -246,18 +336,10 @@ class TelemetryGatherer:
         if self._disabled:
             return response
 
-        response_headers = dict(response.headers)
-        
-        # Mask sensitive headers in response
-        for header_name in list(response_headers.keys()):
-            if header_name.lower() in self.SENSITIVE_HEADERS:
-                response_headers[header_name] = '*' * len(response_headers[header_name])
-        
-        # Apply general masking
-        response_headers = self._mask_data(response_headers)
+        response_headers = self._mask_headers(response.headers)
 
         payload = g.treblle_payload
-        payload['data']['response'] = {
+        response_payload = payload['data']['response'] = {
             'code': response.status_code or 200,
             'headers': response_headers,
             'load_time': int((time()-g.treblle_start_time) * 1000),
@@ -266,11 +348,14 @@ class TelemetryGatherer:
         if isinstance(response.response, GeneratorType):
             # streaming response - we don't want to block the request thread to wait for the response to finish
             # or load the entire response into memory
-            payload['data']['response'].update({'size': 0, 'body': {}})
+            response_payload.update({'size': 0, 'body': {}})
         else:
-            if self._response_transformer:
+            # response.data joins the response iterable on every access, read it once
+            response_data = response.get_data()
+            response_transformer = self._response_transformer
+            if response_transformer:
                 # Check if response body exceeds 2MB limit before transformation
-                if len(response.data) > self.MAX_RESPONSE_BODY_SIZE:
+                if len(response_data) > self.MAX_RESPONSE_BODY_SIZE:
                     payload['data']['errors'].append({
                         'source': 'onError',
                         'type': 'E_USER_ERROR',
@@ -282,28 +367,29 @@ class TelemetryGatherer:
                     response_size = 0
                 else:
                     try:
-                        response_body = self._response_transformer(response.data)
+                        response_body = response_transformer(response_data)
                         try:
                             dumps(response_body)
                         except JSONDecodeError:
                             raise ValueError('Response transformer must return a JSON serializable object')
+                        response_body = self._mask_data(response_body)
 
                     except Exception as e:
-                        logger.error(f'Error in response transformer: {e.__class__.__name__}{e.args}')
-                        last_frame = extract_tb(e.__traceback__)[-1]
+                        logger.error('Error in response transformer: %s%s', e.__class__.__name__, e.args)
+                        file, line = _last_frame(e.__traceback__)
                         payload['data']['errors'].append({
                             'source': 'onError',
                             'type': e.__class__.__name__,
                             'message': ', '.join(str(f) for f in e.args),
-                            'file': last_frame.filename,
-                            'line': last_frame.lineno
+                            'file': file,
+                            'line': line
                         })
                         response_body = {}
-                    response_size = len(response.data)
+                    response_size = len(response_data)
 
             else:
                 # Check if response body exceeds 2MB limit
-                if len(response.data) > self.MAX_RESPONSE_BODY_SIZE:
+                if len(response_data) > self.MAX_RESPONSE_BODY_SIZE:
                     payload['data']['errors'].append({
                         'source': 'onError',
                         'type': 'E_USER_ERROR',
@@ -314,35 +400,38 @@ class TelemetryGatherer:
                     response_body = {}
                     response_size = 0
                 else:
-                    try:
-                        response_body = loads(response.data.decode('utf-8', 'replace'))
-                    except (JSONDecodeError, UnicodeDecodeError):
-                        response_body = {}
-                    response_size = len(response.data)
+                    # parsing and masking is left to the publisher thread, if there's nothing to mask the raw body is
+                    # spliced into the payload as-is
+                    response_body = RawJSON(response_data, self._mask_data, self._can_skip_masking)
+                    response_size = len(response_data)
 
-            payload['data']['response']['body'] = self._mask_data(response_body) if response_body else {}
-            payload['data']['response']['size'] = response_size
+            response_payload['body'] = response_body if response_body else {}
+            response_payload['size'] = response_size
 
         return response
 
     def finalize(self, exception):
-        if self._disabled or not hasattr(g, 'treblle_payload'):
+        if self._disabled:
+            return
+
+        payload = getattr(g, 'treblle_payload', None)
+        if payload is None:
             return
 
         # Add root level timestamp and request ID
-        g.treblle_payload['timestamp'] = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
-        g.treblle_payload['request_id'] = str(uuid4())
+        payload['timestamp'] = _utc_timestamp()
+        payload['request_id'] = _request_id()
 
         if exception:
             # treblle doesn't support entire traceback, we'll only send the last frame
-            last_frame = extract_tb(exception.__traceback__)[-1]
+            file, line = _last_frame(exception.__traceback__)
 
-            g.treblle_payload['data']['errors'].append({
+            payload['data']['errors'].append({
                 'source': 'onError',
                 'type': exception.__class__.__name__,
                 'message': ', '.join(str(f) for f in exception.args),
-                'file': last_frame.filename,
-                'line': last_frame.lineno
+                'file': file,
+                'line': line
             })
 
-        return g.treblle_payload
+        return payload
@@ -10,14 +10,123 @@ publishing telemetry to Treblle backend.
 You shouldn't use this class directly, instead use Treblle class from the extension module.
 """
 
-from aiohttp import ClientSession
-from asyncio import new_event_loop, run_coroutine_threadsafe, set_event_loop
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from asyncio import Queue, QueueFull, gather, new_event_loop, run_coroutine_threadsafe, set_event_loop, wait_for
 from itertools import cycle
-from logging import getLogger
+from json import dumps as _json_dumps
+from logging import getLogger, DEBUG
+from os import urandom
 from threading import Thread
+from zlib import DEFLATED, compressobj
+
+try:
+    from orjson import dumps as _orjson_dumps, loads as json_loads, JSONEncodeError, OPT_NON_STR_KEYS
+
+    def json_dumps(obj):
+        try:
+            return _orjson_dumps(obj, option=OPT_NON_STR_KEYS)
+        except JSONEncodeError:
+            # orjson is stricter than the json module, e.g. it rejects integers above 64 bits, which transformer
+            # output validated with the json module can still contain
+            return _json_dumps(obj).encode('utf-8')
+except ImportError:
+    from json import loads as _json_loads
+
+    def json_dumps(obj):
+        return _json_dumps(obj).encode('utf-8')
+
+    def json_loads(data):
+        return _json_loads(data.decode('utf-8'))
 
 logger = getLogger('treblle')
 
+# Random so that it can't be forged by the request data we're splicing the raw bodies next to
+_RAW_JSON_PLACEHOLDER = f'treblle-raw-json-{urandom(16).hex()}'
+
+
+class RawJSON:
+    """
+    Request or response body which is (likely) already JSON encoded. Instead of parsing it on the request thread and
+    serializing it again, it is validated and spliced into the payload as-is when publishing.
+
+    If a mask function is given, the masked result is sent instead, unless the optional can_skip_masking check shows
+    the body can't contain anything to mask. Both are called on the publisher thread.
+    """
+    # a plain wrapper rather than a bytes subclass, orjson only accepts exact bytes instances
+    __slots__ = ('data', 'mask', 'can_skip_masking')
+
+    def __init__(self, data, mask=None, can_skip_masking=None):
+        self.data = data
+        self.mask = mask
+        self.can_skip_masking = can_skip_masking
+
+    def __len__(self):
+        return len(self.data)
+
+
+def _prepare_raw_bodies(data):
+    """
+    Validates RawJSON request/response bodies in the payload data, replacing the valid ones with placeholders, or with
+    their parsed and masked value if they need masking. Returns a list of (placeholder, raw body) pairs to splice into
+    the serialized payload.
+    """
+    raw_bodies = []
+    for section in ('request', 'response'):
+        section_data = data.get(section)
+        if not section_data or not isinstance(section_data.get('body'), RawJSON):
+            continue
+
+        raw_body = section_data['body']
+        mask = raw_body.mask
+        if mask and raw_body.can_skip_masking and raw_body.can_skip_masking(raw_body.data):
+            mask = None
+
+        # note that orjson parses integers above 64 bits as floats, so those lose precision when the body is masked
+        try:
+            body = json_loads(raw_body.data)
+        except ValueError:
+            body = {}
+            # retrying with lenient decoding can only help if the body isn't valid UTF-8, otherwise (e.g. HTML or
+            # plain text responses) it would fail the same way again
+            if not raw_body.data.isascii():
+                try:
+                    raw_body.data.decode('utf-8')
+                except UnicodeDecodeError:
+                    try:
+                        body = json_loads(raw_body.data.decode('utf-8', 'replace').encode('utf-8'))
+                    except ValueError:
+                        pass
+            if body and mask:
+                body = mask(body)
+            section_data['body'] = body or {}
+            continue
+
+        if not body:
+            section_data['body'] = {}
+            continue
+
+        if mask:
+            section_data['body'] = mask(body)
+            continue
+
+        placeholder = f'{_RAW_JSON_PLACEHOLDER}-{section}'
+        section_data['body'] = placeholder
+        raw_bodies.append((json_dumps(placeholder), raw_body.data))
+
+    return raw_bodies
+
+
+def _splice_raw_bodies(encoded, raw_bodies):
+    for placeholder, raw_body in raw_bodies:
+        encoded = encoded.replace(placeholder, raw_body, 1)
+    return encoded
+
+
+def encode_payload(payload):
+    """Serializes the payload to JSON bytes, splicing in any RawJSON request/response bodies."""
+    raw_bodies = _prepare_raw_bodies(payload['data'])
+    return _splice_raw_bodies(json_dumps(payload), raw_bodies)
+
 
 class TelemetryPublisher:
     _instance = None
@@ -27,6 +136,13 @@ class TelemetryPublisher:
         'https://sicario.treblle.com',
     ]
     TIMEOUT_SECONDS = 2
+    # Payloads are discarded after ingestion, so trade a slightly larger body for much cheaper compression
+    COMPRESSION_LEVEL = 1
+    # Payloads waiting to be published are bounded so a slow ingest can't exhaust memory, overflow is dropped
+    MAX_QUEUED_PAYLOADS = 10000
+    MAX_CONCURRENT_REQUESTS = 32
+    KEEPALIVE_TIMEOUT_SECONDS = 75
+    DNS_CACHE_TTL_SECONDS = 300
 
     def __init__(self, treblle_sdk_token, treblle_api_key, custom_url=None):
         """
@@ -43,6 +159,8 @@ class TelemetryPublisher:
         else:
             self._hosts_cycle = cycle(self.BACKEND_HOSTS)
         self._session = None
+        self._queue = None
+        self._workers = []
 
         self._event_loop = new_event_loop()
         self._publisher_thread = Thread(target=self._run_event_loop)
@@ -50,56 +168,103 @@ class TelemetryPublisher:
 
     def _run_event_loop(self):
         set_event_loop(self._event_loop)
+        self._queue = Queue(maxsize=self.MAX_QUEUED_PAYLOADS)
         self._event_loop.run_until_complete(self._init_session())
+        self._workers = [
+            self._event_loop.create_task(self._consume_queue()) for _ in range(self.MAX_CONCURRENT_REQUESTS)
+        ]
         self._event_loop.run_forever()
 
     async def _init_session(self):
-        self._session = await ClientSession().__aenter__()
+        # keep connections to the ingest hosts alive between payloads so we don't pay for a TLS handshake every time
+        connector = TCPConnector(
+            limit=self.MAX_CONCURRENT_REQUESTS, limit_per_host=self.MAX_CONCURRENT_REQUESTS,
+            keepalive_timeout=self.KEEPALIVE_TIMEOUT_SECONDS, ttl_dns_cache=self.DNS_CACHE_TTL_SECONDS,
+            enable_cleanup_closed=True
+        )
+        self._session = await ClientSession(
+            connector=connector, timeout=ClientTimeout(total=self.TIMEOUT_SECONDS)
+        ).__aenter__()
 
     async def _close_session(self):
+        # give the already queued payloads a chance to be published before shutting down
+        try:
+            await wait_for(self._queue.join(), timeout=self.TIMEOUT_SECONDS)
+        except Exception:
+            pass
+
+        for worker in self._workers:
+            worker.cancel()
+        await gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
         if self._session:
             await self._session.__aexit__(None, None, None)
             self._session = None
 
+    def _compress_payload(self, payload):
+        # wbits=31 makes zlib write the GZIP header and trailer
+        compressor = compressobj(self.COMPRESSION_LEVEL, DEFLATED, 31)
+        return compressor.compress(encode_payload(payload)) + compressor.flush()
+
     async def _process_request(self, payload):
         try:
             host_url = next(self._hosts_cycle)
-            logger.debug(f'Treblle: Sending telemetry to {host_url}')
-            import gzip
-            import json
+            logger.debug('Treblle: Sending telemetry to %s', host_url)
             
             # Compress payload with GZIP as required by Treblle
-            json_data = json.dumps(payload).encode('utf-8')
-            compressed_data = gzip.compress(json_data)
+            compressed_data = self._compress_payload(payload)
             
             response = await self._session.post(
-                url=host_url, data=compressed_data, timeout=self.TIMEOUT_SECONDS,
+                url=host_url, data=compressed_data,
                 headers={
                     'X-API-Key': self._treblle_sdk_token,
                     'Content-Type': 'application/json',
                     'Content-Encoding': 'gzip'
                 }
             )
-            response_text = await response.text()
-            logger.debug(f'Treblle: Response status: {response.status}')
-            logger.debug(f'Treblle: Response body: {response_text}')
+            # read the body as bytes so the connection can be reused, it's only decoded when it's logged
+            response_body = await response.read()
+            logger.debug('Treblle: Response status: %s', response.status)
+            if logger.isEnabledFor(DEBUG):
+                logger.debug('Treblle: Response body: %s', response_body.decode('utf-8', 'replace'))
             if response.status >= 300:
-                logger.warning(f'Treblle API error {response.status}: {response_text}')
+                logger.warning('Treblle API error %s: %s', response.status, response_body.decode('utf-8', 'replace'))
             elif response.status == 200:
-                if 'error' in response_text.lower() or 'invalid' in response_text.lower():
-                    logger.warning(f'Treblle: 200 OK but with error message: {response_text}')
+                response_body_lower = response_body.lower()
+                if b'error' in response_body_lower or b'invalid' in response_body_lower:
+                    logger.warning(
+                        'Treblle: 200 OK but with error message: %s', response_body.decode('utf-8', 'replace')
+                    )
                 else:
                     logger.info('Treblle: Request accepted successfully')
         except Exception as e:
-            logger.debug(f'Failed to send telemetry: {e.__class__.__name__}{e.args}')
+            logger.debug('Failed to send telemetry: %s%s', e.__class__.__name__, e.args)
 
-    def send_to_treblle(self, payload):
-        future = run_coroutine_threadsafe(self._process_request(payload), self._event_loop)
-        # Wait a short time to get the response for debugging
+    async def _consume_queue(self):
+        while True:
+            payload = await self._queue.get()
+            try:
+                await self._process_request(payload)
+            finally:
+                self._queue.task_done()
+
+    def _enqueue(self, payload):
         try:
-            future.result(timeout=3)  # Wait up to 3 seconds for response
-        except Exception as e:
-            logger.warning(f'Treblle: Request failed: {e}')
+            self._queue.put_nowait(payload)
+        except QueueFull:
+            logger.debug('Treblle: Telemetry queue is full, dropping payload')
+
+    def send_to_treblle(self, payload, block=False):
+        if block:
+            future = run_coroutine_threadsafe(self._process_request(payload), self._event_loop)
+            try:
+                future.result(timeout=self.TIMEOUT_SECONDS + 1)
+            except Exception as e:
+                logger.warning('Treblle: Request failed: %s', e)
+        else:
+            # fire-and-forget, we don't want to hold the request thread while telemetry is being published
+            self._event_loop.call_soon_threadsafe(self._enqueue, payload)
 
     def teardown(self):
         if self._session: